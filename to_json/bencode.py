@@ -30,6 +30,9 @@
 #
 # Various "treat all data as flawed and don't break if it is" bug fixes.
 
+from operator import itemgetter
+
+
 class BTFailure(Exception):
     pass
 
@@ -43,11 +46,37 @@ class Bencached(object):
 
 
 class Bensorted(object):
-    __slots__ = ['sorted']
+    __slots__ = ['sorted', '_idx', '_span']
 
     # noinspection PyPropertyAccess
     def __init__(self, s):
         self.sorted = s
+        # Index of each key into self.sorted, built the first time a larger
+        # dictionary is looked up, see _find
+        self._idx = None
+        # When decoded, the (start, end) offsets of the encoded dictionary in
+        # the input, so it can be hashed without re-encoding it
+        self._span = None
+
+    def _find(self, key):
+        # Returns the position of key in self.sorted, or -1 if it's not there.
+        # Most dictionaries only have a few keys and are quicker to scan than
+        # to index, so only bigger ones get an index.  Either way, the first
+        # occurrence of a key wins.
+        idx = self._idx
+        if idx is None:
+            if len(self.sorted) <= 8:
+                i = 0
+                for k, _v in self.sorted:
+                    if k == key:
+                        return i
+                    i += 1
+                return -1
+            idx = {}
+            for i, (k, _v) in enumerate(self.sorted):
+                idx.setdefault(k, i)
+            self._idx = idx
+        return idx.get(key, -1)
 
     def __iter__(self):
         return self.sorted.__iter__()
@@ -55,124 +84,148 @@ class Bensorted(object):
     def __len__(self):
         return len(self.sorted)
 
+    def keys(self):
+        return dict.fromkeys(k for k, _v in self.sorted).keys()
+
     def __getitem__(self, key):
-        for k, v in self.sorted:
-            if k == key:
-                return v
-        raise KeyError()
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.sorted[i][1]
 
     def __setitem__(self, key, value):
-        for i in range(len(self.sorted)):
-            if self.sorted[i][0] == key:
-                self.sorted[i] = (key, value)
-                return
-        raise KeyError()
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        self.sorted[i] = (key, value)
+        self._span = None
 
     def __contains__(self, key):
-        for k, _v in self.sorted:
-            if k == key:
-                return True
-        return False
+        return self._find(key) >= 0
 
     def get(self, key, default_value):
-        for k, v in self.sorted:
-            if k == key:
-                return v
-        return default_value
-
-
-def decode_int(decode_func_type, x, f):
-    f += 1
-    newf = x.index(b'e', f)
-    n = int(x[f:newf])
-    if x[f] == b'-'[0]:
-        if x[f + 1] == b'0':
+        i = self._find(key)
+        if i < 0:
+            return default_value
+        return self.sorted[i][1]
+
+
+# Classification of every possible leading byte of a token, indexed directly
+# by the byte value rather than hashing it into a dict
+TOKEN_INVALID, TOKEN_STRING, TOKEN_INT, TOKEN_LIST, TOKEN_DICT, TOKEN_END = range(6)
+decode_token = [TOKEN_INVALID] * 256
+for _c in b'0123456789':
+    decode_token[_c] = TOKEN_STRING
+decode_token[b'i'[0]] = TOKEN_INT
+decode_token[b'l'[0]] = TOKEN_LIST
+decode_token[b'd'[0]] = TOKEN_DICT
+decode_token[b'e'[0]] = TOKEN_END
+decode_token = tuple(decode_token)
+
+# The value of each ASCII digit, -1 for anything else
+decode_digit = tuple(c - 0x30 if 0x30 <= c <= 0x39 else -1 for c in range(256))
+
+
+def decode(x, in_order):
+    # Iterative decoder, walking the buffer with a single position index and
+    # keeping the containers still being filled on an explicit stack.  This
+    # avoids a Python function call (and a dispatch table lookup) per token.
+    # x only needs indexing, slicing and find(), so it can be an mmap of the
+    # file rather than a copy of it in memory.
+    stack = []
+    # The container currently being filled, or None at the top level
+    cont = None
+    is_dict = False
+    # The key waiting for its value when filling a dictionary
+    key = None
+    # Where the current container starts in the input
+    start = 0
+    pos = 0
+    while True:
+        c = x[pos]
+        token = decode_token[c]
+        if token == TOKEN_STRING:
+            # A string, parse the length prefix by hand
+            n = c - 0x30
+            pos += 1
+            c = x[pos]
+            d = decode_digit[c]
+            while d >= 0:
+                n = n * 10 + d
+                pos += 1
+                c = x[pos]
+                d = decode_digit[c]
+            if c != 0x3a:
+                raise ValueError
+            pos += 1
+            if pos + n > len(x):
+                raise ValueError
+            v = x[pos:pos + n]
+            pos += n
+            if is_dict and key is None:
+                key = v
+                continue
+        elif token == TOKEN_END and cont is not None:
+            # End of the current list or dictionary
+            if key is not None:
+                raise ValueError
+            pos += 1
+            if is_dict and in_order:
+                # The (key, value) pairs collected so far become a Bensorted.
+                # The top level dictionary and the info dictionary in it also
+                # note where they are in the input, so they can be hashed
+                # without re-encoding them.
+                v = Bensorted(cont)
+                if len(stack) == 1 or (len(stack) == 2 and stack[1][1] and stack[1][2] == b'info'):
+                    v._span = (start, pos)
+            else:
+                v = cont
+            cont, is_dict, key, start = stack.pop()
+        elif is_dict and key is None:
+            # Dictionary keys must be strings
+            raise ValueError
+        elif token == TOKEN_INT:
+            pos += 1
+            newpos = x.find(b'e', pos)
+            if newpos < 0:
+                raise ValueError
+            v = int(x[pos:newpos])
+            if x[pos] == 0x30 and newpos != pos + 1:
+                raise ValueError
+            pos = newpos + 1
+        elif token == TOKEN_LIST:
+            stack.append((cont, is_dict, key, start))
+            cont, is_dict, key, start = [], False, None, pos
+            pos += 1
+            continue
+        elif token == TOKEN_DICT:
+            # Ordered dictionaries are filled as a list of (key, value) pairs
+            stack.append((cont, is_dict, key, start))
+            cont, is_dict, key, start = [] if in_order else {}, True, None, pos
+            pos += 1
+            continue
+        else:
             raise ValueError
-    elif x[f] == b'0'[0] and newf != f + 1:
-        raise ValueError
-    return n, newf + 1
-
-
-def decode_string(decode_func_type, x, f):
-    colon = x.index(b':', f)
-    n = int(x[f:colon])
-    if x[f] == '0' and colon != f + 1:
-        raise ValueError
-    colon += 1
-    return x[colon:colon + n], colon + n
-
-
-def decode_list(decode_func_type, x, f):
-    r, f = [], f + 1
-    while x[f] != b'e'[0]:
-        # noinspection PyCallingNonCallable
-        v, f = decode_func_type[x[f]](decode_func_type, x, f)
-        r.append(v)
-    return r, f + 1
-
-
-def decode_dict(decode_func_type, x, f):
-    r, f = {}, f + 1
-    while x[f] != b'e'[0]:
-        k, f = decode_string(decode_func_type, x, f)
-        # noinspection PyCallingNonCallable
-        r[k], f = decode_func_type[x[f]](decode_func_type, x, f)
-    return r, f + 1
-
-
-def decode_dict_ordered(decode_func_type, x, f):
-    r = Bensorted([])
-    f = f + 1
-    while x[f] != b'e'[0]:
-        k, f = decode_string(decode_func_type, x, f)
-        # noinspection PyCallingNonCallable
-        v, f = decode_func_type[x[f]](decode_func_type, x, f)
-        r.sorted.append((k, v))
-    return r, f + 1
-
-
-decode_func = {
-    b'l'[0]: decode_list,
-    b'd'[0]: decode_dict,
-    b'i'[0]: decode_int,
-    b'0'[0]: decode_string,
-    b'1'[0]: decode_string,
-    b'2'[0]: decode_string,
-    b'3'[0]: decode_string,
-    b'4'[0]: decode_string,
-    b'5'[0]: decode_string,
-    b'6'[0]: decode_string,
-    b'7'[0]: decode_string,
-    b'8'[0]: decode_string,
-    b'9'[0]: decode_string,
-}
-
 
-decode_func_ordered = {
-    b'l'[0]: decode_list,
-    b'd'[0]: decode_dict_ordered,
-    b'i'[0]: decode_int,
-    b'0'[0]: decode_string,
-    b'1'[0]: decode_string,
-    b'2'[0]: decode_string,
-    b'3'[0]: decode_string,
-    b'4'[0]: decode_string,
-    b'5'[0]: decode_string,
-    b'6'[0]: decode_string,
-    b'7'[0]: decode_string,
-    b'8'[0]: decode_string,
-    b'9'[0]: decode_string,
-}
+        # Store the value we just decoded in its parent
+        if cont is None:
+            return v, pos
+        elif not is_dict:
+            cont.append(v)
+        elif in_order:
+            cont.append((key, v))
+            key = None
+        else:
+            cont[key] = v
+            key = None
 
 
 def bdecode(x, in_order=False):
+    if isinstance(x, (bytearray, memoryview)):
+        # Slicing these doesn't produce bytes, which are needed for dict keys
+        x = bytes(x)
     try:
-        if in_order:
-            # noinspection PyCallingNonCallable
-            r, l = decode_func_ordered[x[0]](decode_func_ordered, x, 0)
-        else:
-            # noinspection PyCallingNonCallable
-            r, l = decode_func[x[0]](decode_func, x, 0)
+        r, l = decode(x, in_order)
     except (IndexError, KeyError, ValueError):
         raise BTFailure("not a valid bencoded string")
     if l != len(x):
@@ -181,43 +234,49 @@ def bdecode(x, in_order=False):
 
 
 def encode_bencached(x, r):
-    r.append(x.bencoded)
+    r += x.bencoded
 
 
 def encode_int(x, r):
-    r.extend((b'i', str(x).encode("utf8"), b'e'))
+    r += b'i%de' % x
 
 
 def encode_string(x, r):
-    r.extend((str(len(x)).encode("utf8"), b':', x))
+    r += b'%d:' % len(x)
+    r += x
 
 
 def encode_list(x, r):
-    r.append(b'l')
+    r += b'l'
     for i in x:
         # noinspection PyCallingNonCallable
         encode_func[type(i)](i, r)
-    r.append(b'e')
+    r += b'e'
+
+
+_item_key = itemgetter(0)
 
 
 def encode_dict(x, r):
-    r.append(b'd')
-    ilist = list(x.items())
-    ilist.sort()
-    for k, v in ilist:
-        r.extend((str(len(k)).encode("utf8"), b':', k))
+    r += b'd'
+    # Sorting on the key alone lets the sort compare bytes directly, rather
+    # than going through a tuple comparison for every pair
+    for k, v in sorted(x.items(), key=_item_key):
+        r += b'%d:' % len(k)
+        r += k
         # noinspection PyCallingNonCallable
         encode_func[type(v)](v, r)
-    r.append(b'e')
+    r += b'e'
 
 
 def encode_bensorted(x, r):
-    r.append(b'd')
+    r += b'd'
     for k, v in x.sorted:
-        r.extend((str(len(k)).encode("utf8"), b':', k))
+        r += b'%d:' % len(k)
+        r += k
         # noinspection PyCallingNonCallable
         encode_func[type(v)](v, r)
-    r.append(b'e')
+    r += b'e'
 
 
 encode_func = {
@@ -231,11 +290,21 @@ encode_func = {
 }
 
 
-def bencode(x):
-    r = []
+def bencode(x, out=None):
+    # If a bytearray is passed in as out, the encoded data is appended to it
+    # and it's returned, letting the caller hash or write the data without
+    # making another copy of it.
+    r = bytearray() if out is None else out
     # noinspection PyCallingNonCallable
     encode_func[type(x)](x, r)
-    return b''.join(r)
+    return bytes(r) if out is None else r
+
+
+# Use the compiled version from bencode_c.pyx when it's been built
+try:
+    from bencode_c import bdecode, bencode
+except ImportError:
+    pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+# Compiled version of bdecode and bencode from bencode.py.  It produces the
+# same objects (including Bensorted for in_order decodes) and raises the same
+# errors, so it can be swapped in without callers noticing.  Build it with:
+#
+#   cythonize -i bencode_c.pyx
+#
+# bencode.py picks it up automatically when it's importable, otherwise the
+# pure Python version is used.
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from libc.stdint cimport uint16_t, uint64_t
+from libc.string cimport memcpy
+
+import gc
+from operator import itemgetter
+
+from bencode import BTFailure, Bencached, Bensorted
+
+_item_key = itemgetter(0)
+
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    static inline int bencode_ctz64(unsigned long long v) {
+        unsigned long i;
+        _BitScanForward64(&i, v);
+        return (int)i;
+    }
+    #else
+    static inline int bencode_ctz64(unsigned long long v) {
+        return __builtin_ctzll(v);
+    }
+    #endif
+
+    #include "structmember.h"
+
+    static PyObject *bencode_alloc(PyObject *type) {
+        return ((PyTypeObject *)type)->tp_alloc((PyTypeObject *)type, 0);
+    }
+
+    static Py_ssize_t bencode_slot_offset(PyObject *descr) {
+        return ((PyMemberDescrObject *)descr)->d_member->offset;
+    }
+
+    static void bencode_set_slot(PyObject *obj, Py_ssize_t offset, PyObject *value) {
+        Py_INCREF(value);
+        *(PyObject **)((char *)obj + offset) = value;
+    }
+    """
+    int bencode_ctz64(unsigned long long v) nogil
+    object bencode_alloc(object type)
+    Py_ssize_t bencode_slot_offset(object descr)
+    void bencode_set_slot(object obj, Py_ssize_t offset, object value)
+
+
+# Bensorted's __init__ is Python code, and calling it for every decoded dict
+# costs about as much as the rest of decoding it.  Instead, allocate them
+# without it and store straight into their (freshly allocated, empty) slots,
+# using the offsets from the slot descriptors.
+cdef Py_ssize_t SLOT_SORTED = bencode_slot_offset(Bensorted.__dict__['sorted'])
+cdef Py_ssize_t SLOT_IDX = bencode_slot_offset(Bensorted.__dict__['_idx'])
+cdef Py_ssize_t SLOT_SPAN = bencode_slot_offset(Bensorted.__dict__['_span'])
+
+
+cdef inline object new_bensorted(list items, object span):
+    v = bencode_alloc(Bensorted)
+    bencode_set_slot(v, SLOT_SORTED, items)
+    bencode_set_slot(v, SLOT_IDX, None)
+    bencode_set_slot(v, SLOT_SPAN, span)
+    return v
+
+
+cdef uint16_t _endian_probe = 1
+cdef bint LITTLE_ENDIAN = (<unsigned char *>&_endian_probe)[0] == 1
+
+
+cdef inline int swar_digits(const unsigned char *s, uint64_t *value) noexcept nogil:
+    # Parses the run of ASCII digits at the start of the 8 bytes at s, eight
+    # bytes at a time (SWAR), returning how many digits there were (0 to 8)
+    # and storing their value.  Only valid on little endian machines.
+    cdef uint64_t chunk, bad, val
+    cdef int k
+    memcpy(&chunk, s, 8)
+    # A byte is a digit if its high nibble is 3 and its low nibble plus 6
+    # doesn't carry into the high nibble.  Set the top bit of every byte
+    # that isn't one, and count the digits before the first of those.
+    bad = (((chunk & 0xF0F0F0F0F0F0F0F0ULL) ^ 0x3030303030303030ULL)
+           | (((chunk & 0x0F0F0F0F0F0F0F0FULL) + 0x0606060606060606ULL) & 0xF0F0F0F0F0F0F0F0ULL))
+    bad = (((bad & 0x7F7F7F7F7F7F7F7FULL) + 0x7F7F7F7F7F7F7F7FULL) | bad) & 0x8080808080808080ULL
+    k = 8 if bad == 0 else bencode_ctz64(bad) >> 3
+    if k == 0:
+        value[0] = 0
+        return 0
+    # Move the digits to the top of the word, so the bytes below them act as
+    # leading zeros, then combine pairs of digits, pairs of those, and so on
+    val = (chunk & 0x0F0F0F0F0F0F0F0FULL) << (8 * (8 - k))
+    val = (val * 2561) >> 8
+    val = ((val & 0x00FF00FF00FF00FFULL) * 6553601) >> 16
+    val = ((val & 0x0000FFFF0000FFFFULL) * 42949672960001ULL) >> 32
+    value[0] = val
+    return k
+
+
+def bdecode(x, in_order=False):
+    cdef const unsigned char[:] buf
+    cdef const unsigned char *p
+    cdef Py_ssize_t pos = 0, n_x, start, i, n, cont_start = 0
+    cdef long long iv
+    cdef uint64_t u
+    cdef unsigned char c
+    cdef bint is_dict = False, neg
+
+    buf = x
+    n_x = buf.shape[0]
+    if n_x == 0:
+        raise BTFailure("not a valid bencoded string")
+    p = &buf[0]
+
+    # Same iterative walk as the pure Python decoder
+    stack = []
+    cont = None
+    key = None
+    # Decoding creates lots of containers, which keeps triggering the cyclic
+    # garbage collector, and it ends up spending more time walking the
+    # half-built result than the decoder spends building it.  What's built
+    # here can't contain cycles, so pause it until we're done.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while True:
+            if pos >= n_x:
+                raise ValueError
+            c = p[pos]
+            if c == 0x65 and cont is not None:
+                # 'e', end of the current list or dictionary
+                if key is not None:
+                    raise ValueError
+                pos += 1
+                if is_dict and in_order:
+                    # Same as the pure Python decoder, only the top level and
+                    # info dictionaries note where they are in the input
+                    if len(stack) == 1 or (len(stack) == 2 and stack[1][1] and stack[1][2] == b'info'):
+                        v = new_bensorted(cont, (cont_start, pos))
+                    else:
+                        v = new_bensorted(cont, None)
+                else:
+                    v = cont
+                cont, is_dict, key, cont_start = stack.pop()
+            elif 0x30 <= c <= 0x39:
+                # '0'-'9', a string, parse up to 8 digits of the length at
+                # once if there's room, the loop below picks up any others
+                if LITTLE_ENDIAN and pos + 8 <= n_x:
+                    pos += swar_digits(p + pos, &u)
+                    n = <Py_ssize_t>u
+                else:
+                    n = c - 0x30
+                    pos += 1
+                while True:
+                    if pos >= n_x:
+                        raise ValueError
+                    c = p[pos]
+                    if c == 0x3a:
+                        break
+                    if c < 0x30 or c > 0x39 or n > n_x:
+                        raise ValueError
+                    n = n * 10 + c - 0x30
+                    pos += 1
+                pos += 1
+                if n > n_x - pos:
+                    raise ValueError
+                v = PyBytes_FromStringAndSize(<const char *>p + pos, n)
+                pos += n
+                if is_dict and key is None:
+                    key = v
+                    continue
+            elif is_dict and key is None:
+                # Dictionary keys must be strings
+                raise ValueError
+            elif c == 0x69:
+                # 'i', an integer
+                pos += 1
+                start = pos
+                while pos < n_x and p[pos] != 0x65:
+                    pos += 1
+                if pos >= n_x:
+                    raise ValueError
+                # Plain integers that fit in a long long are parsed here
+                i = start
+                neg = p[i] == 0x2d
+                if neg:
+                    i += 1
+                iv = 0
+                if pos - i <= 18:
+                    while i < pos and 0x30 <= p[i] <= 0x39:
+                        iv = iv * 10 + p[i] - 0x30
+                        i += 1
+                if i == pos and pos > start + neg:
+                    v = -iv if neg else iv
+                else:
+                    # Long or unusual integers, let Python deal with them
+                    v = int(PyBytes_FromStringAndSize(<const char *>p + start, pos - start))
+                if p[start] == 0x30 and pos != start + 1:
+                    raise ValueError
+                pos += 1
+            elif c == 0x6c:
+                # 'l', start of a list
+                stack.append((cont, is_dict, key, cont_start))
+                cont, is_dict, key, cont_start = [], False, None, pos
+                pos += 1
+                continue
+            elif c == 0x64:
+                # 'd', start of a dictionary
+                # Ordered dictionaries are filled as a list of (key, value) pairs
+                stack.append((cont, is_dict, key, cont_start))
+                cont, is_dict, key, cont_start = [] if in_order else {}, True, None, pos
+                pos += 1
+                continue
+            else:
+                raise ValueError
+
+            # Store the value we just decoded in its parent
+            if cont is None:
+                break
+            elif not is_dict:
+                cont.append(v)
+            elif in_order:
+                cont.append((key, v))
+                key = None
+            else:
+                cont[key] = v
+                key = None
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string")
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if pos != n_x:
+        raise BTFailure("invalid bencoded value (data after valid prefix)")
+    return v
+
+
+cdef encode(x, bytearray r):
+    t = type(x)
+    if t is bytes:
+        r += b'%d:' % len(x)
+        r += x
+    elif t is int:
+        r += b'i%de' % x
+    elif t is Bensorted:
+        r += b'd'
+        for k, v in x.sorted:
+            r += b'%d:' % len(k)
+            r += k
+            encode(v, r)
+        r += b'e'
+    elif t is list or t is set:
+        r += b'l'
+        for i in x:
+            encode(i, r)
+        r += b'e'
+    elif t is dict:
+        r += b'd'
+        for k, v in sorted(x.items(), key=_item_key):
+            r += b'%d:' % len(k)
+            r += k
+            encode(v, r)
+        r += b'e'
+    elif t is Bencached:
+        r += x.bencoded
+    else:
+        raise KeyError(t)
+
+
+def bencode(x, out=None):
+    r = bytearray() if out is None else out
+    encode(x, r)
+    return bytes(r) if out is None else r
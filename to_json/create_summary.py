@@ -1,25 +1,67 @@
 #!/usr/bin/env python3
 
 import tor_cache_data
+from collections import OrderedDict
+import hashlib
 import json
+import mmap
+import os
 import sys
 
+# decode_torrent's results only depend on the bytes passed in, so keep the most
+# recent ones around, keyed by a hash of the data, to avoid decoding the same
+# torrent again when it's seen repeatedly.  The cache is limited both by the
+# number of torrents and by the total number of files across them, since a
+# single torrent can list millions of files.
+DECODE_CACHE_SIZE = 256
+DECODE_CACHE_MAX_FILES = 1000000
+_decode_cache = OrderedDict()
+_decode_cache_files = 0
+
+def fingerprint(data):
+    # Torrent files come from anywhere, so this needs to be a cryptographic
+    # hash, otherwise a crafted file could collide with one that's cached and
+    # be handed its results
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+# Every hit returns the same TorrentFiles object, which is read-only.  extra is
+# a plain dict callers might reasonably add to, so each caller gets a copy.
+def decode_torrent_cached(data):
+    global _decode_cache_files
+    key = fingerprint(data)
+    ret = _decode_cache.get(key)
+    if ret is None:
+        ret = tor_cache_data.decode_torrent(data)
+        file_count = len(ret[1])
+        # Torrents too big to ever fit aren't cached at all
+        if file_count <= DECODE_CACHE_MAX_FILES:
+            _decode_cache[key] = ret
+            _decode_cache_files += file_count
+            while len(_decode_cache) > DECODE_CACHE_SIZE or _decode_cache_files > DECODE_CACHE_MAX_FILES:
+                _old_key, old = _decode_cache.popitem(last=False)
+                _decode_cache_files -= len(old[1])
+    else:
+        _decode_cache.move_to_end(key)
+    name, files, piece_length, extra = ret
+    return name, files, piece_length, dict(extra)
+
+
+def clean_size(size):
+    if type(size) is int:
+        return size
+    try:
+        return int(size)
+    except:
+        return 0
+
 def tor_to_summary(data):
-    name, files, piece_length, extra = tor_cache_data.decode_torrent(data)
+    name, files, piece_length, extra = decode_torrent_cached(data)
     file_count = len(files)
-    file_size = 0
-    extensions = set()
-    for cur in files:
-        try:
-            temp = int(cur['size'])
-            cur['size'] = temp
-            file_size += temp
-            extensions.add(cur['name'].split('.')[-1].lower())
-        except:
-            cur['size'] = 0
+    file_size = files.total_size
+    extensions = files.extensions
     body = {
         'ih': extra['v1_hash'], 
-        'files': files, 
+        'files': [{'name': n, 'size': clean_size(s)} for n, s in zip(files.names, files.sizes)], 
         'name': name,
         'files_count': file_count,
         'files_size': file_size,
@@ -38,10 +80,15 @@ def main():
     if len(sys.argv) != 2:
         print("Neeed .torrent file to parse")
     
+    # Map the file rather than reading it, the decoder can work straight off
+    # of the mapping, so large torrents don't need to be copied into memory
     with open(sys.argv[1], "rb") as f:
-        data = f.read()
-    
-    summary = tor_to_summary(data)
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be mapped
+            summary = tor_to_summary(b'')
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                summary = tor_to_summary(data)
 
     print(json.dumps(summary, sort_keys=True, indent=2))
 
@@ -4,6 +4,19 @@ from bencode import bdecode, bencode, Bensorted
 import json
 import hashlib
 
+# Well-known keys from the torrent and info dictionaries
+K_INFO = b'info'
+K_NAME = b'name'
+K_NAME_UTF8 = b'name.utf-8'
+K_FILES = b'files'
+K_LENGTH = b'length'
+K_PATH = b'path'
+K_PATH_UTF8 = b'path.utf-8'
+K_PIECES = b'pieces'
+K_PIECE_LEN = b'piece length'
+K_FILE_TREE = b'file tree'
+K_META_VERSION = b'meta version'
+
 # Function to convert a torrent file to a useful summary of data
 # Handles buggy clients, oddball encodings, and other real-world issues.
 # This can either be called from the command line, or as a library.
@@ -35,11 +48,61 @@ import hashlib
 #   but things that are spec'd as being byte arrays sometimes aren't, so 
 #   you'll need to verify that before calling this function, and make 
 #   decisions on what to do before calling this helper.
+#
+# SAFE_ASCII is the translation table for the fallback, mapping everything
+# outside of the "Safe ASCII" range to '.'
+SAFE_ASCII = bytes(x if x >= 32 and x <= 126 else 0x2e for x in range(256))
+
+
 def safe_decode(value):
     try:
         return value.decode('utf-8', 'surrogatepass')
     except UnicodeDecodeError:
-        return "".join([chr(x) if x >= 32 and x <= 126 else '.' for x in value])
+        return value.translate(SAFE_ASCII).decode('ascii')
+
+
+# The list of files in a torrent.  Rather than a dictionary per file, this keeps
+# the names and sizes in two parallel lists, which is far smaller for torrents
+# with many files and lets callers run over one or the other directly.
+# decode_torrent fills it in with add(), after that it's read-only.  Indexing,
+# slicing, or iterating it gives new {'name': ..., 'size': ...} dictionaries,
+# built on demand, so changing those doesn't change the list.  Use to_list() for
+# a plain list of them, for instance to pass to json.dumps.
+# The total size and set of extensions are tallied up as files are added, so
+# summaries don't need another pass over the lists.  Files with sizes that
+# can't be turned into a number don't count towards either.
+class TorrentFiles(object):
+    __slots__ = ['names', 'sizes', 'total_size', 'extensions']
+
+    def __init__(self):
+        self.names = []
+        self.sizes = []
+        self.total_size = 0
+        self.extensions = set()
+
+    def add(self, name, size):
+        self.names.append(name)
+        self.sizes.append(size)
+        try:
+            self.total_size += int(size)
+        except (TypeError, ValueError):
+            return
+        self.extensions.add(name.split('.')[-1].lower())
+
+    def to_list(self):
+        return [{'name': name, 'size': size} for name, size in zip(self.names, self.sizes)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [{'name': name, 'size': size} for name, size in zip(self.names[i], self.sizes[i])]
+        return {'name': self.names[i], 'size': self.sizes[i]}
+
+    def __iter__(self):
+        for name, size in zip(self.names, self.sizes):
+            yield {'name': name, 'size': size}
 
 
 # Decodes a torrent file, loading the list of files and some other metadata from the
@@ -49,22 +112,23 @@ def safe_decode(value):
 # max_files = Optional max number of files to include in the list
 # decode_names = Attempt to decode names, otherwise, just return empty strings
 def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
-    name, files, piece_length = '', [], 0
+    name, files, piece_length = '', TorrentFiles(), 0
 
     # Hand off the heavy lifting of decoding the bdecode format, note that we keep
     # dictionaries in order so that we can re-encode them and have a byte-for-byte
     # matching encoding with how it came in
-    torrent = bdecode(torrent, in_order=True)
-    if b'info' in torrent:
+    data = torrent
+    torrent = bdecode(data, in_order=True)
+    if K_INFO in torrent:
         # Pull out the info dictionary, this is the 'core' of the torrent
-        torrent = torrent[b'info']
+        torrent = torrent[K_INFO]
 
-    piece_length = torrent.get(b'piece length', 0)
+    piece_length = torrent.get(K_PIECE_LEN, 0)
 
-    if b'file tree' in torrent and isinstance(torrent.get(b'file tree', None), Bensorted):
+    if K_FILE_TREE in torrent and isinstance(torrent.get(K_FILE_TREE, None), Bensorted):
         # This torrent is a v2 torrent, pull out the v2 metadata
         if decode_names:
-            name = torrent.get(b'name.utf-8', torrent.get(b'name', b''))
+            name = torrent.get(K_NAME_UTF8, torrent.get(K_NAME, b''))
             if isinstance(name, list):
                 try:
                     name = name[0]
@@ -86,17 +150,17 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
 
                 if isinstance(value, Bensorted):
                     if b"" in value and len(value) == 1:
-                        files.append({'name': "/".join(cur_path + [cur]), 'size': value[b""].get(b"length", 0)})
+                        files.add("/".join(cur_path + [cur]), value[b""].get(K_LENGTH, 0))
                     else:
                         decode_file_tree(value, cur_path + [cur])
 
-        decode_file_tree(torrent[b'file tree'], [])
-    elif b'files' in torrent:
+        decode_file_tree(torrent[K_FILE_TREE], [])
+    elif K_FILES in torrent:
         # This torrent has multiple files, first off, try to get
         # The name of the torrent.  Most clients use this as
         # the folder to download into
         if decode_names:
-            name = torrent.get(b'name.utf-8', torrent.get(b'name', b''))
+            name = torrent.get(K_NAME_UTF8, torrent.get(K_NAME, b''))
             if isinstance(name, list):
                 try:
                     name = name[0]
@@ -114,7 +178,7 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
 
         # Now run through each file and decode it
         file_index = 0
-        for current_file in torrent[b'files']:
+        for current_file in torrent[K_FILES]:
             file_index += 1
             if max_files is not None:
                 if max_files == 0:
@@ -125,9 +189,9 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
             if decode_names:
                 temp = [name]
 
-                parts = current_file.get(b'path.utf-8', None)
+                parts = current_file.get(K_PATH_UTF8, None)
                 if parts is None:
-                    parts = current_file.get(b'path', [])
+                    parts = current_file.get(K_PATH, [])
                 if isinstance(parts, Bensorted):
                     parts = []
                 if not isinstance(parts, list):
@@ -148,7 +212,7 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
                 temp = ""
 
             # Also get the size, including dealing with oddities
-            size = current_file.get(b'length', 0)
+            size = current_file.get(K_LENGTH, 0)
             if isinstance(size, list):
                 try:
                     size = size[0]
@@ -159,12 +223,12 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
                     size = int(size.decode("utf-8"))
                 except:
                     size = 0
-            files.append({'name': temp, 'size': size})
+            files.add(temp, size)
     else:
         # This is a single file torrent, so its name is the filename
-        if (b'name.utf-8' in torrent or b'name' in torrent) and b'length' in torrent:
+        if (K_NAME_UTF8 in torrent or K_NAME in torrent) and K_LENGTH in torrent:
             if decode_names:
-                temp = torrent.get(b'name.utf-8', torrent.get(b'name', b''))
+                temp = torrent.get(K_NAME_UTF8, torrent.get(K_NAME, b''))
                 if isinstance(temp, list):
                     try:
                         temp = name[0]
@@ -179,7 +243,7 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
                 temp = ""
             
             # Single file torrents also have a length, deal with odd values here too
-            size = torrent[b'length']
+            size = torrent[K_LENGTH]
             if isinstance(size, list):
                 try:
                     size = size[0]
@@ -190,30 +254,42 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
                     size = int(size.decode("utf-8"))
                 except:
                     size = 0
-            files.append({'name': temp, 'size': size})
+            files.add(temp, size)
 
     if not quiet:
-        print("Describing torrent as '%s', '%s', '%d'" % (name, json.dumps(files), piece_length))
+        print("Describing torrent as '%s', '%s', '%d'" % (name, json.dumps(files.to_list()), piece_length))
 
     # Store some useful metadata, might be useful to find trends
     extra = {}
-    extra['piece_hash'] = hashlib.sha1(torrent.get(b"pieces", b'')).hexdigest()
-    extra['first_chunk'] = torrent.get(b"pieces", b'')[0:20].hex()
-
-    # Calculate a hash of the list of files to create a fingerprint
-    files_hash = hashlib.sha1()
-    for cur in sorted(files, key=lambda x:(x["name"], x["size"])):
-        files_hash.update(cur["name"].encode("utf-8", "surrogatepass"))
-        files_hash.update(str(cur["size"]).encode("utf-8", "surrogatepass"))
-    extra['files_hash'] = files_hash.hexdigest()
+    extra['piece_hash'] = hashlib.sha1(torrent.get(K_PIECES, b'')).hexdigest()
+    extra['first_chunk'] = torrent.get(K_PIECES, b'')[0:20].hex()
+
+    # Calculate a hash of the list of files to create a fingerprint, gathering
+    # everything into one buffer so it's hashed in a single call.  Sorting the
+    # (name, size) tuples themselves keeps the comparisons entirely in C.
+    files_hash = bytearray()
+    for file_name, size in sorted(zip(files.names, files.sizes)):
+        files_hash += file_name.encode("utf-8", "surrogatepass")
+        if type(size) is int:
+            files_hash += b'%d' % size
+        else:
+            files_hash += str(size).encode("utf-8", "surrogatepass")
+    extra['files_hash'] = hashlib.sha1(files_hash).hexdigest()
 
     # Look for the version of the torrent, if it has 'file tree' or 'meta version' in
     # the info dictionary, it's a v2 torrent.
-    extra['torrent_version'] = torrent.get(b"meta version", 1)
-    extra['hybrid'] = extra['torrent_version'] >= 2 and b'pieces' in torrent
-
-    # And calculate the infohash
-    torrent_data = bencode(torrent)
+    extra['torrent_version'] = torrent.get(K_META_VERSION, 1)
+    extra['hybrid'] = extra['torrent_version'] >= 2 and K_PIECES in torrent
+
+    # And calculate the infohash.  The decoder notes where the info dictionary is
+    # in the input, so hash those bytes directly, only falling back to
+    # re-encoding it if that's not known.  Note that hashlib's sha1 and sha256
+    # are OpenSSL's implementations in any normal build, and those already use
+    # the CPU's SHA instructions when it has them.
+    if isinstance(torrent, Bensorted) and torrent._span is not None:
+        torrent_data = memoryview(data)[torrent._span[0]:torrent._span[1]]
+    else:
+        torrent_data = memoryview(bencode(torrent, bytearray()))
     try:
         temp = hashlib.sha1(torrent_data).hexdigest()
         extra['v1_hash'] = temp
@@ -227,68 +303,115 @@ def decode_torrent(torrent, quiet=True, max_files=None, decode_names=True):
     except:
         extra['v2_hash'] = 'unknown'
 
+    # Let go of the view now, in case the data is an mmap that the caller closes
+    torrent_data.release()
+
     return name, files, piece_length, extra
 
 
-def dump_dict(dump_data, value, header="", parent_key=""):
-    if isinstance(value, int):
-        dump_data(f"{header}{value}")
-        header = " " * len(header)
-    elif isinstance(value, str):
-        dump_data(f"{header}{value}")
-        header = " " * len(header)
-    elif isinstance(value, bytes):
-        dump_data(f"{header}{value.decode('utf-8')}")
+def dump_scalar(dump_data, value, header, parent_key):
+    dump_data(f"{header}{value}")
+
+
+def dump_bytes(dump_data, value, header, parent_key):
+    dump_data(f"{header}{value.decode('utf-8')}")
+
+
+def dump_list(dump_data, value, header, parent_key):
+    for i in range(len(value)):
+        dump_dict(dump_data, value[i], f"{header}[{i}]", parent_key+"["+str(i)+"]")
         header = " " * len(header)
-    elif isinstance(value, list):
-        for i in range(len(value)):
-            dump_dict(dump_data, value[i], f"{header}[{i}]", parent_key+"["+str(i)+"]")
-            header = " " * len(header)
-    elif isinstance(value, (dict, Bensorted)):
-        for key in sorted(value.keys()):
-            sub = value[key]
-            try:
-                key = key.decode("utf-8")
-            except:
-                key = key.hex()
-            if key in {"path", "path.utf-8"}:
-                is_list = False
-                if isinstance(sub, list):
-                    is_list = True
-                    for i in range(len(sub)):
-                        obj = sub[i]
-                        if isinstance(obj, bytes):
-                            obj = obj.decode("utf-8")
-                            sub[i] = obj
-                        if not isinstance(obj, str):
-                            is_list = False
-                            break
-                if is_list:
-                    sub = "/".join(sub)
-
-            if isinstance(sub, int):
-                dump_data(f"{header}{key}: {sub}")
-                header = " " * len(header)
-            elif isinstance(sub, str):
-                dump_data(f"{header}{key}: {sub}")
-                header = " " * len(header)
-            elif isinstance(sub, (dict, list, Bensorted)):
-                dump_data(f"{header}{key}:")
-                header = " " * len(header)
-                dump_dict(dump_data, sub, header + "  ", parent_key+key)
-            elif isinstance(sub, bytes):
-                try:
-                    if len(sub) == 0:
-                        raise Exception()
-                    temp = sub.decode("utf-8")
-                except:
-                    temp = f"<binary data of {len(sub)} bytes>"
-                dump_data(f"{header}{key}: {temp}")
-                header = " " * len(header)
-            else:
+
+
+def dump_sub_scalar(dump_data, key, sub, header, parent_key):
+    dump_data(f"{header}{key}: {sub}")
+
+
+def dump_sub_nested(dump_data, key, sub, header, parent_key):
+    dump_data(f"{header}{key}:")
+    dump_dict(dump_data, sub, " " * len(header) + "  ", parent_key+key)
+
+
+def dump_sub_bytes(dump_data, key, sub, header, parent_key):
+    try:
+        if len(sub) == 0:
+            raise Exception()
+        temp = sub.decode("utf-8")
+    except:
+        temp = f"<binary data of {len(sub)} bytes>"
+    dump_data(f"{header}{key}: {temp}")
+
+
+def dump_mapping(dump_data, value, header, parent_key):
+    for key in sorted(value.keys()):
+        sub = value[key]
+        try:
+            key = key.decode("utf-8")
+        except:
+            key = key.hex()
+        if key in {"path", "path.utf-8"}:
+            is_list = False
+            if isinstance(sub, list):
+                is_list = True
+                for i in range(len(sub)):
+                    obj = sub[i]
+                    if isinstance(obj, bytes):
+                        obj = obj.decode("utf-8")
+                        sub[i] = obj
+                    if not isinstance(obj, str):
+                        is_list = False
+                        break
+            if is_list:
+                sub = "/".join(sub)
+
+        handler = DUMP_SUB_HANDLERS.get(type(sub))
+        if handler is None:
+            handler = find_handler(DUMP_SUB_HANDLERS, sub)
+            if handler is None:
                 raise Exception("Unknown sub type: " + str(type(sub)))
-    else:
-        raise Exception("Unknown value type: " + str(type(value)))
+        handler(dump_data, key, sub, header, parent_key)
+        header = " " * len(header)
+
+
+# How to dump each type of value, looked up by the exact type so the common
+# cases are a single dict lookup rather than a series of isinstance() calls
+DUMP_HANDLERS = {
+    int: dump_scalar,
+    str: dump_scalar,
+    bytes: dump_bytes,
+    list: dump_list,
+    dict: dump_mapping,
+    Bensorted: dump_mapping,
+}
+
+
+# The same, for values inside of a dictionary, which are shown next to their key
+DUMP_SUB_HANDLERS = {
+    int: dump_sub_scalar,
+    str: dump_sub_scalar,
+    dict: dump_sub_nested,
+    list: dump_sub_nested,
+    Bensorted: dump_sub_nested,
+    bytes: dump_sub_bytes,
+}
+
+
+# Subclasses of the types above aren't found by the exact type lookup, so fall
+# back to checking each one in turn
+def find_handler(handlers, value):
+    for kind, handler in handlers.items():
+        if isinstance(value, kind):
+            return handler
+    return None
+
+
+def dump_dict(dump_data, value, header="", parent_key=""):
+    handler = DUMP_HANDLERS.get(type(value))
+    if handler is None:
+        handler = find_handler(DUMP_HANDLERS, value)
+        if handler is None:
+            raise Exception("Unknown value type: " + str(type(value)))
+    handler(dump_data, value, header, parent_key)
 
 
 def cmd_decode(filename):
@@ -305,10 +428,10 @@ def cmd_filenames(filename):
     with open(filename, "rb") as f:
         body = f.read()
     data = bdecode(body)
-    name = data[b'info'][b'name'].decode("utf-8")
-    if b'files' in data[b'info']:
-        for cur in data[b'info'][b'files']:
-            temp = [name] + [x.decode("utf-8") for x in cur[b'path']]
+    name = data[K_INFO][K_NAME].decode("utf-8")
+    if K_FILES in data[K_INFO]:
+        for cur in data[K_INFO][K_FILES]:
+            temp = [name] + [x.decode("utf-8") for x in cur[K_PATH]]
             print("/".join(temp))
     else:
         print(name)
@@ -329,7 +452,7 @@ def cmd_pretty(filename):
         print(f"{cur['name']} ({cur['size']})")
     header("Extra")
     print(f"File count: {len(files)}")
-    print(f"Data size: {sum(x['size'] for x in files)}")
+    print(f"Data size: {files.total_size}")
     for key, value in extra.items():
         print(f"{key}: {value}")
 